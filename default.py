@@ -1,5 +1,12 @@
 # -*- coding: utf-8 -*-
-from resources.lib import addon
+import sys
+from urlparse import urlparse
 
 if __name__ == '__main__':
-    addon.run()
+    if urlparse(sys.argv[0]).path.startswith('/widget'):
+        # widgets are served from the service's snapshot, skip the full add-on setup
+        from resources.lib import widget
+        widget.run()
+    else:
+        from resources.lib import addon
+        addon.run()
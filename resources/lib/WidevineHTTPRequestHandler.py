@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+A local license proxy forwarding InputStream Adaptive's Widevine requests to C More's license server
+"""
+import time
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import requests
+
+# service certificate requests consist of this fixed challenge
+SERVICE_CERTIFICATE_CHALLENGE = b'\x08\x04'
+# headers that only concern the connection between InputStream Adaptive and the proxy
+HOP_BY_HOP_HEADERS = ['host', 'content-length', 'connection', 'keep-alive', 'accept-encoding']
+
+
+class WidevineProxyServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, request_handler, log=None, pool_size=10):
+        SocketServer.TCPServer.__init__(self, server_address, request_handler)
+        self.log = log or (lambda string: None)
+        # all handler threads share the upstream connections
+        self.http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http_session.mount('http://', adapter)
+        self.http_session.mount('https://', adapter)
+        self.service_certificates = {}
+        self.certificates_lock = threading.Lock()
+
+    def get_service_certificate(self, license_server):
+        with self.certificates_lock:
+            return self.service_certificates.get(license_server)
+
+    def set_service_certificate(self, license_server, certificate):
+        with self.certificates_lock:
+            self.service_certificates[license_server] = certificate
+
+
+class WidevineHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    upstream_timeout = 15
+
+    def do_POST(self):
+        """Forward a license request to the license server given in the query string."""
+        start_time = time.time()
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path != '/license' or 'server' not in query:
+            self.send_error(404)
+            return
+        license_server = query['server'][0]
+        challenge = self.rfile.read(int(self.headers.get('content-length', 0)))
+
+        if challenge == SERVICE_CERTIFICATE_CHALLENGE:
+            certificate = self.server.get_service_certificate(license_server)
+            if certificate:
+                self.send_license_response(200, 'application/octet-stream', certificate)
+                self.server.log('Served cached service certificate in {0:.0f} ms'.format((time.time() - start_time) * 1000))
+                return
+
+        headers = dict((key, value) for key, value in self.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS)
+        try:
+            response = self.server.http_session.post(license_server, data=challenge, headers=headers,
+                                                     timeout=self.upstream_timeout)
+        except requests.exceptions.RequestException as error:
+            self.server.log('License request failed: {0}'.format(str(error)))
+            self.send_error(502)
+            return
+
+        if challenge == SERVICE_CERTIFICATE_CHALLENGE and response.status_code == 200:
+            self.server.set_service_certificate(license_server, response.content)
+        self.send_license_response(response.status_code, response.headers.get('content-type'), response.content)
+        self.server.log('License request answered with {0} in {1:.0f} ms (upstream {2:.0f} ms)'.format(
+            response.status_code, (time.time() - start_time) * 1000, response.elapsed.total_seconds() * 1000))
+
+    def send_license_response(self, status_code, content_type, content):
+        self.send_response(status_code)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        """Send the access log to the Kodi log instead of stderr."""
+        self.server.log('{0} - {1}'.format(self.client_address[0], format % args))
@@ -3,13 +3,13 @@ import json
 from datetime import datetime
 
 from resources.lib.kodihelper import KodiHelper
+from resources.lib.payloads import AssetPayloads
 import routing
 
 base_url = sys.argv[0]
 handle = int(sys.argv[1])
-helper = KodiHelper(base_url, handle)
+helper = KodiHelper(base_url, handle, sys.argv[2])
 plugin = routing.Plugin()
-info_locale = helper.c.locale.split('_')[0]
 
 
 def run():
@@ -112,6 +112,7 @@ def list_assets(params=[]):
         if 'sort_by' in param:
             if param['sort_by'] == 'episode_number':
                 assets = sorted(assets, key=lambda x: x['episode_number'])
+                helper.set_episode_queue([x['video_id'] for x in assets])
                 break
             elif param['sort_by'] == 'start_time':
                 assets = sorted(assets, key=lambda x: x['events'][0]['start_time'])
@@ -124,9 +125,10 @@ def list_assets(params=[]):
         'unscripted_episode': add_episode,
         'sport': add_sport
     }
+    payloads = AssetPayloads(helper.c)
     for asset in assets:
         if asset['type'] in assets_routing:
-            assets_routing[asset['type']](asset)
+            assets_routing[asset['type']](asset, payloads.get(asset))
         else:
             helper.log('Unsupported asset found: %s' % asset['type'])
     helper.eod()
@@ -155,46 +157,18 @@ def list_seasons():
         list_assets(params)
 
 
-def add_movie(asset):
-    info = {
-        'mediatype': 'movie',
-        'title': asset['title_{locale}'.format(locale=info_locale)],
-        'originaltitle': asset['original_title']['text'],
-        'genre': asset.get('genre_description_{locale}'.format(locale=info_locale)),
-        'plot': asset['description_extended_{locale}'.format(locale=info_locale)],
-        'plotoutline': asset['description_short_{locale}'.format(locale=info_locale)],
-        'country': asset['country'],
-        'cast': [x['name'] for x in asset['credits'] if x['function'] == 'actor'],
-        'director': [x['name'] for x in asset['credits'] if x['function'] == 'director'],
-        'year': int(asset['production_year']),
-        'duration': int(asset['duration']),
-        'studio': asset['studio']
-    }
-    helper.add_item(info['title'], plugin.url_for(play, video_id=asset['video_id']), info=info, art=add_art(asset),
-                    content='movies', playable=True)
-
-
-def add_series(asset):
-    info = {
-        'mediatype': 'tvshow',
-        'title': asset['title_{locale}'.format(locale=info_locale)],
-        'tvshowtitle': asset['title_{locale}'.format(locale=info_locale)],
-        'genre': asset.get('genre_description_{locale}'.format(locale=info_locale)),
-        'plot': asset['description_extended_{locale}'.format(locale=info_locale)],
-        'plotoutline': asset['description_short_{locale}'.format(locale=info_locale)],
-        'country': asset['country'],
-        'cast': [x['name'] for x in asset['credits'] if x['function'] == 'actor'],
-        'director': [x['name'] for x in asset['credits'] if x['function'] == 'director'],
-        'year': int(asset['production_year']),
-        'studio': asset['studio'],
-        'season': len(asset['seasons_cmore_{site}'.format(site=helper.c.locale_suffix)])
-    }
-    helper.add_item(info['title'], plugin.url_for(list_seasons, asset=json.dumps(asset)), info=info, art=add_art(asset),
-                    content='tvshows')
+def add_movie(asset, payload):
+    helper.add_item(payload['title'], plugin.url_for(play, video_id=asset['video_id']), info=payload['info'],
+                    art=payload['art'], content='movies', playable=True)
+
+
+def add_series(asset, payload):
+    helper.add_item(payload['title'], plugin.url_for(list_seasons, asset=json.dumps(payload['series'])),
+                    info=payload['info'], art=payload['art'], content='tvshows')
 
 
-def add_sport(asset):
-    asset_date = helper.c.parse_datetime(asset['events'][0]['start_time'])
+def add_sport(asset, payload):
+    asset_date = datetime.fromtimestamp(payload['start_time'])
     if datetime.now().date() == asset_date.date():
         start_time = helper.language(30035).format(asset_date.strftime('%H:%M'))
     else:
@@ -203,6 +177,7 @@ def add_sport(asset):
     if asset_date > datetime.now():
         event_status = 'upcoming'
         playable = False
+        helper.add_upcoming_event(asset['video_id'], payload['title'], payload['start_time'])
         plugin_url = plugin.url_for(dialog, dialog_type='ok',
                                     heading=helper.language(30017),
                                     message=helper.language(30036).format(start_time))
@@ -214,97 +189,14 @@ def add_sport(asset):
         playable = True
         plugin_url = plugin.url_for(play, video_id=asset['video_id'])
 
-    info = {
-        'mediatype': 'video',
-        'originaltitle': asset['original_title']['text'],
-        'title': asset['title_{locale}'.format(locale=info_locale)],
-        'genre': asset['league_{locale}'.format(locale=info_locale)],
-        'plot': asset['description_short_{locale}'.format(locale=info_locale)],
-        'year': int(asset['production_year']),
-        'cast': [x['name'] for x in asset['credits']]
-    }
-
-    list_title = '[B]{0}:[/B] {1}'.format(coloring(start_time, event_status).encode('utf-8'),
-                                          info['title'].encode('utf-8'))
-    helper.add_item(list_title, plugin_url, info=info, art=add_art(asset), content='episodes', playable=playable)
-
-
-def add_episode(asset):
-    info = {
-        'mediatype': 'episode',
-        'title': asset['title_{locale}'.format(locale=info_locale)].replace(':', ''),
-        'tvshowtitle': asset['brand']['title_{locale}'.format(locale=info_locale)],
-        'genre': asset.get('genre_description_{locale}'.format(locale=info_locale)),
-        'plot': asset['description_extended_{locale}'.format(locale=info_locale)],
-        'country': asset['country'],
-        'cast': [x['name'] for x in asset['credits'] if x['function'] == 'actor'],
-        'director': [x['name'] for x in asset['credits'] if x['function'] == 'director'],
-        'year': int(asset['production_year']),
-        'duration': int(asset['duration']),
-        'studio': asset['brand']['studio'],
-        'season': asset['season']['season_number'],
-        'episode': asset['episode_number']
-    }
-
-    helper.add_item(episode_list_title(asset), plugin.url_for(play, video_id=asset['video_id']), info=info,
-                    art=add_art(asset),
-                    content='episodes', playable=True)
-
+    list_title = u'[B]{0}:[/B] {1}'.format(coloring(start_time, event_status), payload['title'])
+    helper.add_item(list_title, plugin_url, info=payload['info'], art=payload['art'], content='episodes',
+                    playable=playable)
 
-def episode_list_title(asset):
-    season = asset['season']['season_number']
-    episode = asset['episode_number']
-    title = asset['title_{locale}'.format(locale=info_locale)].replace(':', '')
-    if int(season) <= 9:
-        season_format = '0' + str(season)
-    else:
-        season_format = str(season)
-    if int(episode) <= 9:
-        episode_format = '0' + str(episode)
-    else:
-        episode_format = str(episode)
-
-    return '[B]S{season_format}E{episode_format}[/B]: {title}'.format(season_format=season_format,
-                                                                      episode_format=episode_format,
-                                                                      title=title.encode('utf-8'))
-
-
-def add_art(asset):
-    poster = None
-    fanart = None
-
-    if asset['poster']['localizations']:
-        try:
-            poster = [x['url'] for x in asset['poster']['localizations'] if x['language'] == helper.c.locale][0]
-        except IndexError:
-            poster = asset['poster']['localizations'][0]['url']
-    if not poster:
-        poster = asset['poster']['url']
-
-    if asset['poster']['localizations']:
-        try:
-            fanart = [x['url'] for x in asset['landscape']['localizations'] if x['language'] == helper.c.locale][0]
-        except IndexError:
-            fanart = asset['landscape']['localizations'][0]['url']
-
-    if not fanart:
-        fanart = asset['landscape']['url']
-    if asset['type'] == 'movie':
-        thumbnail = poster
-    else:
-        thumbnail = fanart
-
-    artwork = {
-        'poster': poster,
-        'fanart': fanart,
-        'landscape': fanart,
-        'thumb': thumbnail
-    }
-    for art, url in artwork.items():
-        if 'aspx' not in url:  # filmnet cdn can't be proxied for some reason
-            artwork[art] = helper.c.image_proxy(url)
 
-    return artwork
+def add_episode(asset, payload):
+    helper.add_item(payload['title'], plugin.url_for(play, video_id=asset['video_id']), info=payload['info'],
+                    art=payload['art'], content='episodes', playable=True)
 
 
 def coloring(text, meaning):
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+A simple file based cache for C More, safe to share between concurrent add-on invocations
+"""
+import os
+import json
+import time
+import uuid
+import errno
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+
+def atomic_write(path, content):
+    """Write content to path so that concurrent readers see either the old or the new file, never a partial one.
+    Text content is written as UTF-8."""
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fh_temp:
+            fh_temp.write(content)
+        try:
+            os.rename(temp_path, path)
+        except OSError:  # windows doesn't allow renaming over an existing file
+            os.remove(path)
+            os.rename(temp_path, path)
+    except (IOError, OSError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class Cache(object):
+    # locks older than this are considered left behind by a crashed invocation
+    lock_timeout = 30
+
+    def __init__(self, cache_folder, log=None):
+        self.cache_folder = cache_folder
+        self.log = log or (lambda string: None)
+        try:
+            os.makedirs(self.cache_folder)
+        except OSError as error:  # another invocation may have created it
+            if error.errno != errno.EEXIST:
+                raise
+
+    def get_path(self, key, extension='.json'):
+        """Return the path of the file holding the cache entry for key."""
+        filename = hashlib.sha1(key.encode('utf-8')).hexdigest() + extension
+        return os.path.join(self.cache_folder, filename)
+
+    def get_entry(self, key):
+        """Return the raw cache entry (timestamp and data) for key or None if it doesn't exist."""
+        try:
+            with open(self.get_path(key), 'rb') as fh_cache:
+                return json.loads(fh_cache.read())
+        except (IOError, ValueError):
+            return None
+
+    def get(self, key, max_age=None):
+        """Return the cached data for key. Entries older than max_age (in seconds) are ignored."""
+        entry = self.get_entry(key)
+        if not entry:
+            return None
+        if max_age is not None and time.time() - entry['timestamp'] > max_age:
+            return None
+
+        return entry['data']
+
+    def set(self, key, data):
+        """Store data for key. Failures are logged and ignored, the cache is only an optimisation."""
+        entry = {
+            'timestamp': time.time(),
+            'data': data
+        }
+        try:
+            # unescaped UTF-8 is much faster to load than \u escapes on python 2
+            atomic_write(self.get_path(key), json.dumps(entry, ensure_ascii=False))
+        except (IOError, OSError) as error:  # e.g. another invocation has the file open on windows
+            self.log('Failed to write cache entry {0}: {1}'.format(key, str(error)))
+
+    def delete(self, key):
+        """Remove the cache entry for key."""
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            pass
+
+    def sweep(self, max_age, max_ages=None):
+        """Remove entries older than max_age seconds, or the age given for their key in max_ages, and the
+        temporary and lock files crashed invocations left behind. A max_age of None keeps entries.
+        Return the number of files removed."""
+        max_ages = dict((os.path.basename(self.get_path(key)), age) for key, age in (max_ages or {}).items())
+        removed = 0
+        for filename in os.listdir(self.cache_folder):
+            if filename.startswith('.tmp-') or filename.endswith('.lock'):
+                file_max_age = self.lock_timeout
+            elif filename.endswith('.json'):
+                file_max_age = max_ages.get(filename, max_age)
+            else:
+                continue
+            path = os.path.join(self.cache_folder, filename)
+            try:
+                if file_max_age is not None and time.time() - os.path.getmtime(path) > file_max_age:
+                    os.remove(path)
+                    removed += 1
+            except OSError:  # removed by another invocation or still open on windows
+                pass
+
+        return removed
+
+    @contextmanager
+    def lock(self, key, timeout=None):
+        """Hold an exclusive lock for key across processes, waiting up to timeout seconds for it.
+        Yield whether the lock was acquired; on timeout the caller proceeds without it."""
+        if timeout is None:
+            timeout = self.lock_timeout
+        lock_path = self.get_path(key, '.lock')
+        # identifies our lock, it may be broken as stale and taken by another invocation while we hold it
+        token = uuid.uuid4().hex
+        deadline = time.time() + timeout
+        acquired = False
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                try:
+                    os.write(fd, token.encode('ascii'))
+                finally:
+                    os.close(fd)
+                acquired = True
+                break
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+            try:
+                if time.time() - os.path.getmtime(lock_path) > self.lock_timeout:
+                    os.remove(lock_path)
+                    continue
+            except OSError:  # released in the meantime
+                continue
+            if time.time() >= deadline:
+                break
+            time.sleep(0.05)
+
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release(lock_path, token)
+
+    @staticmethod
+    def release(lock_path, token):
+        """Remove the lock file at lock_path unless it was taken over by another invocation."""
+        try:
+            with open(lock_path) as fh_lock:
+                if fh_lock.read() != token:
+                    return
+            os.remove(lock_path)
+        except (IOError, OSError):  # already broken as stale and released
+            pass
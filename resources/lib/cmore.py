@@ -7,15 +7,26 @@ import json
 import codecs
 import calendar
 import time
+import hashlib
+import threading
 from collections import OrderedDict
 from datetime import datetime, timedelta
 
 import requests
 import iso8601
 
+try:
+    import Queue as queue
+except ImportError:  # python 3
+    import queue
+
+from cache import Cache, atomic_write
+from queries import QUERIES
+
 
 class CMore(object):
     base_url = 'https://cmore-mobile-bff.b17g.services'
+    playback_init_url = 'https://bonnier-player-android-prod.b17g.net/init'
     # hopefully, this can be acquired dynamically in the future
     pages = {
         'sv_SE': ['start', 'movies', 'series', 'sports', 'tv', 'programs', 'kids'],
@@ -29,14 +40,45 @@ class CMore(object):
         self.locale_suffix = self.locale.split('_')[1].lower()
         self.http_session = requests.Session()
         self.settings_folder = settings_folder
-        self.config_path = os.path.join(self.settings_folder, 'configuration.json')
+        # config and caches are kept per locale so switching between sites doesn't invalidate them
+        self.config_path = os.path.join(self.settings_folder, 'configuration_{locale}.json'.format(locale=self.locale))
+        self.cache = Cache(os.path.join(self.settings_folder, 'cache', self.locale), log=self.log)
         self.config_version = '3.14.1'
-        self.config = self.get_config()
+        self._config = None
         self.client = 'cmore-kodi'
+        # seconds to wait for API responses, None waits indefinitely
+        self.request_timeout = None
+        # serve cached listing requests up to this many seconds old, None disables it
+        self.max_staleness = None
+        # cached responses older than this many seconds are reported in self.stale_requests
+        self.revalidate_after = 60
+        self.stale_requests = []
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # how long to trust what we learned about the GraphQL APIs' persisted query support
+        self.graphql_support_max_age = 86400
+        # errors (lower case) of APIs that don't support persisted queries when sent only the hash
+        self.persisted_query_unsupported_errors = ['persistedquerynotsupported', 'must provide query',
+                                                   'must contain a non-empty `query`']
+        # playback requests time out after timeout_factor times their 95th percentile latency, within these limits
+        self.timeout_factor = 3
+        self.min_timeout = 5
+        self.max_timeout = 30
+        self.latency_samples = 50
+        self.latency_min_samples = 5
+        # send a duplicate playback request when the first one is slower than the 90th percentile
+        self.hedge_requests = False
 
     class CMoreError(Exception):
         pass
 
+    @property
+    def config(self):
+        """The app configuration. It's loaded on first use so creating an instance needs no network access."""
+        if self._config is None:
+            self._config = self.get_config()
+        return self._config
+
     def log(self, string):
         """C More class log method."""
         if self.debug:
@@ -62,16 +104,97 @@ class CMore(object):
             self.log('Headers: %s' % headers)
 
         if method == 'get':
-            req = self.http_session.get(url, params=params, headers=headers)
+            req = self.http_session.get(url, params=params, headers=headers, timeout=self.request_timeout)
         elif method == 'put':
-            req = self.http_session.put(url, params=params, data=payload, headers=headers)
+            req = self.http_session.put(url, params=params, data=payload, headers=headers,
+                                        timeout=self.request_timeout)
         else:  # post
-            req = self.http_session.post(url, params=params, data=payload, headers=headers)
+            req = self.http_session.post(url, params=params, data=payload, headers=headers,
+                                         timeout=self.request_timeout)
+        self.log('Response code: %s' % req.status_code)
+        self.log('Response: %s' % req.content)
+
+        return self.parse_response(req.content)
+
+    def playback_request(self, name, url, params=None, headers=None):
+        """Make a playback-critical GET request. The timeout is derived from the recorded latencies of
+        requests with the same name and the request is optionally hedged with a duplicate."""
+        history_key = 'latency_{0}'.format(name)
+        history = self.cache.get(history_key) or []
+        if len(history) >= self.latency_min_samples:
+            timeout = min(self.max_timeout, max(self.min_timeout, self.timeout_factor * self.percentile(history, 95)))
+            hedge_after = self.percentile(history, 90) if self.hedge_requests else None
+        else:
+            timeout = self.max_timeout
+            hedge_after = None
+        self.log('Request URL: %s' % url)
+        self.log('Timeout: {0:.1f} seconds, hedge after: {1}'.format(timeout, hedge_after))
+
+        start_time = time.time()
+        try:
+            req = self.hedged_get(url, params, headers, timeout, hedge_after)
+        except requests.exceptions.Timeout:
+            history.append(timeout)
+            self.cache.set(history_key, history[-self.latency_samples:])
+            raise self.CMoreError('The request timed out after {0:.1f} seconds.'.format(timeout))
+        history.append(time.time() - start_time)
+        self.cache.set(history_key, history[-self.latency_samples:])
         self.log('Response code: %s' % req.status_code)
         self.log('Response: %s' % req.content)
 
         return self.parse_response(req.content)
 
+    def hedged_get(self, url, params, headers, timeout, hedge_after=None):
+        """Make a GET request. If hedge_after (seconds) passes without a response, send a duplicate
+        request on a new connection and return whichever response arrives first."""
+        responses = queue.Queue()
+        deadline = time.time() + timeout
+
+        def fetch(session, close=False):
+            try:
+                responses.put((session.get(url, params=params, headers=headers, timeout=timeout), None))
+            except requests.exceptions.RequestException as error:
+                responses.put((None, error))
+            finally:
+                if close:  # the response is read already, only the connection pool is left
+                    session.close()
+
+        requests_sent = 1
+        worker = threading.Thread(target=fetch, args=(self.http_session,))
+        worker.daemon = True
+        worker.start()
+        if hedge_after is not None:
+            try:
+                response, error = responses.get(timeout=hedge_after)
+                if response is not None:
+                    return response
+                requests_sent = 0  # the first request failed, the duplicate replaces it
+            except queue.Empty:
+                pass
+            self.log('No response after {0:.2f} seconds, sending a hedged request.'.format(hedge_after))
+            requests_sent += 1
+            hedge_session = requests.Session()
+            hedge_session.headers.update(self.http_session.headers)
+            worker = threading.Thread(target=fetch, args=(hedge_session, True))
+            worker.daemon = True
+            worker.start()
+
+        error = None
+        for _ in range(requests_sent):
+            try:
+                response, error = responses.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                raise requests.exceptions.Timeout('No response within {0} seconds'.format(timeout))
+            if response is not None:
+                return response
+        raise error
+
+    @staticmethod
+    def percentile(values, percent):
+        """Return the nearest-rank percentile of values."""
+        ordered = sorted(values)
+        return ordered[max(0, int(round(percent / 100.0 * len(ordered))) - 1)]
+
     def parse_response(self, response):
         """Try to load JSON data into dict and raise potential API errors."""
         try:
@@ -91,22 +214,172 @@ class CMore(object):
 
         return response
 
+    def cached_request(self, url, params=None, keep=True):
+        """Make a GET request. Return the cached response if it's younger than self.max_staleness.
+        Responses that aren't kept (keep=False) are never served from cache, but concurrent identical requests
+        still share a single upstream request."""
+        cache_key = self.get_cache_key(url, params)
+        if self.max_staleness and keep:
+            entry = self.cache.get_entry(cache_key)
+            if entry:
+                age = time.time() - entry['timestamp']
+                if age <= self.max_staleness:
+                    self.log('Using cached response for {0} ({1:.0f} seconds old)'.format(url, age))
+                    if age > self.revalidate_after:
+                        self.stale_requests.append({'url': url, 'params': params})
+                    self.cache_hits += 1
+                    return entry['data']
+
+        if keep:
+            self.cache_misses += 1
+        request_time = time.time()
+        # concurrent invocations making the same request wait for the first one instead of repeating it.
+        # responses that aren't kept are handed over in a single entry that the next such request overwrites
+        with self.cache.lock(cache_key):
+            if keep:
+                entry = self.cache.get_entry(cache_key)
+            else:
+                entry = self.cache.get_entry('unkept_response')
+                if entry and entry['data']['request'] == cache_key:
+                    entry['data'] = entry['data']['response']
+                else:
+                    entry = None
+            if entry and entry['timestamp'] >= request_time:
+                self.log('Using response for {0} fetched by a concurrent request'.format(url))
+                return entry['data']
+            data = self.make_request(url, 'get', params=params)
+            if keep:
+                self.cache.set(cache_key, data)
+            else:
+                self.cache.set('unkept_response', {'request': cache_key, 'response': data})
+        return data
+
+    def revalidate(self, url, params=None):
+        """Refresh a cached GET request. Return True if the response differs from the cached one."""
+        cache_key = self.get_cache_key(url, params)
+        entry = self.cache.get_entry(cache_key)
+        data = self.make_request(url, 'get', params=params)
+        self.cache.set(cache_key, data)
+
+        if entry:
+            return self.get_hash(entry['data']) != self.get_hash(data)
+        else:
+            return True
+
+    def get_state_keys(self):
+        """Return the cache keys of what this instance learned about the APIs, as opposed to cached responses."""
+        keys = ['latency_{0}'.format(x) for x in ['playback_init', 'playback_asset', 'playback_item']]
+        config = self.load_config()  # the API URLs, without downloading the config
+        if config:
+            for link in ['graphqlAPI', 'accountDelta', 'accountJune']:
+                if link in config['links']:
+                    keys.append('graphql_support_{0}'.format(config['links'][link]))
+
+        return keys
+
+    @staticmethod
+    def get_cache_key(url, params=None):
+        return json.dumps([url, params], sort_keys=True)
+
+    @staticmethod
+    def get_hash(data):
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def graphql_request(self, url, operation_name, variables, params=None):
+        """Run a query from the query registry. Use persisted query hashes (and GET for cacheable queries)
+        if the API supports them and fall back to sending the full document otherwise."""
+        query, cacheable = QUERIES[operation_name]
+        persisted_query = {
+            'version': 1,
+            'sha256Hash': hashlib.sha256(query.encode('utf-8')).hexdigest()
+        }
+        support_key = 'graphql_support_{0}'.format(url)
+        support = self.cache.get(support_key, max_age=self.graphql_support_max_age) or {'persisted_queries': None,
+                                                                                         'get': None}
+        headers = {'content-type': 'application/json'}
+        payload = {
+            'operationName': operation_name,
+            'variables': variables
+        }
+
+        if support['persisted_queries'] is not False:
+            payload['extensions'] = {'persistedQuery': persisted_query}
+            if cacheable and support['persisted_queries'] and support['get'] is not False:
+                get_params = dict(params or {})
+                get_params.update({
+                    'operationName': operation_name,
+                    'variables': json.dumps(variables, sort_keys=True),
+                    'extensions': json.dumps(payload['extensions'])
+                })
+                try:
+                    data = self.cached_request(url, params=get_params)
+                except self.CMoreError as error:
+                    self.log('GET query {0} failed ({1}), using POST.'.format(operation_name, str(error)))
+                    data = None
+                    if str(error) == 'PersistedQueryNotFound':  # the POST below registers it
+                        support['get'] = None
+                    else:
+                        support['get'] = False
+                else:
+                    support['get'] = isinstance(data, dict) and 'data' in data
+                if support['get']:
+                    self.cache.set(support_key, support)
+                    return data
+                self.cache.delete(self.get_cache_key(url, get_params))
+                self.cache.set(support_key, support)
+            try:
+                data = self.make_request(url, 'post', params=params, payload=json.dumps(payload), headers=headers)
+            except self.CMoreError as error:
+                if str(error) == 'PersistedQueryNotFound':
+                    self.log('Persisted query {0} is unknown to the API, registering it.'.format(operation_name))
+                    support['persisted_queries'] = True
+                elif any(x in str(error).lower() for x in self.persisted_query_unsupported_errors):
+                    self.log('Persisted query {0} failed ({1}), sending the full document.'.format(operation_name,
+                                                                                               str(error)))
+                    support['persisted_queries'] = False
+                    del payload['extensions']
+                else:
+                    raise
+            else:
+                if isinstance(data, dict) and 'data' in data:
+                    support['persisted_queries'] = True
+                    self.cache.set(support_key, support)
+                    return data
+                self.log('Persisted query {0} got an unexpected response, sending the full document.'.format(
+                    operation_name))
+                if support['persisted_queries'] is None:
+                    support['persisted_queries'] = False
+                    del payload['extensions']
+            self.cache.set(support_key, support)
+
+        payload['query'] = query
+        return self.make_request(url, 'post', params=params, payload=json.dumps(payload), headers=headers)
+
     def get_config(self):
         """Return the config in a dict. Re-download if the config version doesn't match self.config_version."""
+        config = self.load_config()
+        if not config or self.config_outdated(config):
+            with self.cache.lock('configuration'):
+                config = self.load_config()  # another invocation may have downloaded it while we waited
+                if not config or self.config_outdated(config):
+                    self.download_config()
+                    config = self.load_config()
+
+        return config
+
+    def load_config(self):
+        """Return the stored config or None if it's missing or unreadable."""
         try:
-            config = json.load(open(self.config_path))['data']
-        except IOError:
-            self.download_config()
-            config = json.load(open(self.config_path))['data']
+            with open(self.config_path) as fh_config:
+                return json.load(fh_config)['data']
+        except (IOError, ValueError, KeyError):
+            return None
 
+    def config_outdated(self, config):
         config_version = int(str(config['settings']['currentAppVersion']).replace('.', ''))
         version_to_use = int(str(self.config_version).replace('.', ''))
         config_lang = config['bootstrap']['suggested_site']['locale']
-        if version_to_use > config_version or config_lang != self.locale:
-            self.download_config()
-            config = json.load(open(self.config_path))['data']
-
-        return config
+        return version_to_use > config_version or config_lang != self.locale
 
     def download_config(self):
         """Download the C More app configuration."""
@@ -116,8 +389,7 @@ class CMore(object):
             'locale': self.locale
         }
         config_data = self.make_request(url, 'get', params=params)
-        with open(self.config_path, 'w') as fh_config:
-            fh_config.write(json.dumps(config_data))
+        atomic_write(self.config_path, json.dumps(config_data))
 
     def get_operators(self):
         """Return a list of TV operators supported by the C More login system."""
@@ -134,23 +406,19 @@ class CMore(object):
         else:
             url = self.config['links']['accountDelta']
         params = {'client': self.client}
-        headers = {'content-type': 'application/json'}
-
-        method = 'post'
-        payload = {
-            'query': 'mutation($username: String!, $password: String, $site: String) {\n  login(credentials: {username: $username, password: $password}, site: $site) {\n    user {\n      ...UserFields\n    }\n    session {\n      token\n      vimondToken\n    }\n  }\n}\nfragment UserFields on User {\n    acceptedCmoreTerms\n    acceptedPlayTerms\n    countryCode\n    email\n    firstName\n    genericAds\n    lastName\n    tv4UserDataComplete\n    userId\n    username\n    yearOfBirth\n    zipCode\n}\n',
-            'variables': {
+        variables = {
             'username': username,
-            'password': password,
-            'site': 'CMORE_{locale_suffix}'.format(locale_suffix=self.locale_suffix.upper())
-                }
-            }
+            'password': password
+        }
         if operator:
-            payload['query'] = '\n    mutation loginTve($operatorName: String!, $username: String!, $password: String, $countryCode: String!) {\n      login(tveCredentials: {\n        operator: $operatorName,\n        username: $username,\n        password: $password,\n        countryCode: $countryCode\n      }) {\n        session{\n          token\n        }\n      }\n    }'
-            payload['variables']['countryCode'] = self.locale_suffix
-            payload['variables']['operatorName'] = operator
+            operation_name = 'LoginTve'
+            variables['countryCode'] = self.locale_suffix
+            variables['operatorName'] = operator
+        else:
+            operation_name = 'Login'
+            variables['site'] = 'CMORE_{locale_suffix}'.format(locale_suffix=self.locale_suffix.upper())
 
-        credentials = self.make_request(url, method, params=params, payload=json.dumps(payload), headers=headers)
+        credentials = self.graphql_request(url, operation_name, variables, params=params)
         return credentials
 
     def get_stream(self, video_id, login_token):
@@ -159,17 +427,17 @@ class CMore(object):
         asset = self.get_playback_asset(video_id, init_data)
         url = '{playback_api}{media_uri}'.format(playback_api=init_data['envPlaybackApi'], media_uri=asset['mediaUri'])
         headers = {'x-jwt': 'Bearer {login_token}'.format(login_token=login_token)}
-        stream = self.make_request(url, 'get', headers=headers)['playbackItem']
+        stream = self.playback_request('playback_item', url, headers=headers)['playbackItem']
         return stream
 
     def get_playback_init(self):
         """Get playback init data (API URL:s and request variables etc)"""
         self.log('Getting playback init.')
-        url = 'https://bonnier-player-android-prod.b17g.net/init'
+        url = self.playback_init_url
         params = {
             'domain': 'cmore.{locale_suffix}'.format(locale_suffix=self.locale_suffix)
         }
-        data = self.make_request(url, 'get', params=params)['config']
+        data = self.playback_request('playback_init', url, params=params)['config']
         return data
 
     def get_playback_asset(self, video_id, init_data):
@@ -182,7 +450,7 @@ class CMore(object):
             'protocol': init_data['envPlaybackProtocol'],
             'drm': init_data['envPlaybackDrm']
         }
-        asset = self.make_request(url, 'get', params=params)
+        asset = self.playback_request('playback_asset', url, params=params)
         return asset
 
     def image_proxy(self, image_url):
@@ -193,6 +461,44 @@ class CMore(object):
         else:
             return None
 
+    def get_art(self, asset):
+        """Return the artwork of an asset, localized if possible and served through the image proxy."""
+        poster = None
+        fanart = None
+
+        if asset['poster']['localizations']:
+            try:
+                poster = [x['url'] for x in asset['poster']['localizations'] if x['language'] == self.locale][0]
+            except IndexError:
+                poster = asset['poster']['localizations'][0]['url']
+        if not poster:
+            poster = asset['poster']['url']
+
+        if asset['poster']['localizations']:
+            try:
+                fanart = [x['url'] for x in asset['landscape']['localizations'] if x['language'] == self.locale][0]
+            except IndexError:
+                fanart = asset['landscape']['localizations'][0]['url']
+
+        if not fanart:
+            fanart = asset['landscape']['url']
+        if asset['type'] == 'movie':
+            thumbnail = poster
+        else:
+            thumbnail = fanart
+
+        artwork = {
+            'poster': poster,
+            'fanart': fanart,
+            'landscape': fanart,
+            'thumb': thumbnail
+        }
+        for art, url in artwork.items():
+            if 'aspx' not in url:  # filmnet cdn can't be proxied for some reason
+                artwork[art] = self.image_proxy(url)
+
+        return artwork
+
     def get_carousels(self, page, namespace='page'):
         carousels = OrderedDict()
         known_containers = ['section_containers', 'genre_containers']
@@ -201,7 +507,7 @@ class CMore(object):
             'locale': self.locale,
             'namespace': namespace
         }
-        data = self.make_request(url, 'get', params=params)['data']
+        data = self.cached_request(url, params=params)['data']
 
         if 'showcase' in data['containers']:
             params = [{'video_ids': ','.join([x['targets'][0]['videoId'] for x in data['containers']['showcase']['items']])}]
@@ -236,7 +542,7 @@ class CMore(object):
             'locale': self.locale,
             'namespace': namespace
         }
-        page_links = self.make_request(url, 'get', params=params)['data']['containers']['page_link_container']['pageLinks']
+        page_links = self.cached_request(url, params=params)['data']['containers']['page_link_container']['pageLinks']
         for page in page_links:
             pages[page['headline']] = {'page': page['id'], 'namespace': page['namespace']}
 
@@ -245,15 +551,8 @@ class CMore(object):
     def get_channels(self):
         url = self.config['links']['graphqlAPI']
         params = {'country': self.locale_suffix}
-        payload = {
-            'operationName': 'EpgQuery',
-            'variables': {
-                'date': datetime.now().strftime('%Y-%m-%d')
-            },
-            'query': 'query EpgQuery($date: String!) {\n  epg(date: $date) {\n    days {\n      channels {\n        asset {\n          id\n          __typename\n        }\n        channelId\n        name\n        title\n        schedules {\n          scheduleId\n          assetId\n          asset {\n            title\n            urlToCDP\n            type\n            __typename\n          }\n          nextStart\n          calendarDate\n          isPremiere\n          isLive\n          program {\n            programId\n            title\n            seasonNumber\n            episodeNumber\n            duration\n            category\n            shortSynopsis\n            imageId\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n'
-        }
-        headers = {'content-type': 'application/json'}
-        data = self.make_request(url, 'post', params=params, payload=json.dumps(payload), headers=headers)['data']
+        variables = {'date': datetime.now().strftime('%Y-%m-%d')}
+        data = self.graphql_request(url, 'EpgQuery', variables, params=params)['data']
         return data['epg']['days'][0]['channels']
 
     def get_assets(self, params):
@@ -266,7 +565,8 @@ class CMore(object):
         if params:
             req_params.update(params)
 
-        assets = self.make_request(url, 'get', params=req_params)['assets']
+        # search results aren't worth keeping
+        assets = self.cached_request(url, params=req_params, keep='q' not in req_params)['assets']
         return assets
 
     def parse_datetime(self, event_date, localize=True):
@@ -1,8 +1,12 @@
 import os
 import urllib
 import re
+import json
 
+import requests
 from cmore import CMore
+from cache import Cache
+from payloads import AssetPayloads
 
 import xbmc
 import xbmcvfs
@@ -13,10 +17,21 @@ from xbmcaddon import Addon
 
 
 class KodiHelper(object):
-    def __init__(self, base_url=None, handle=None):
+    # pre-resolved streams carry short-lived manifest and license tokens
+    prefetch_max_age = 600
+    # home screen widgets list this many start page carousels with up to widget_size items each
+    widget_carousels = 10
+    widget_size = 25
+    # cache entries that aren't responses (support flags, latencies, playback state) are kept this long
+    state_max_age = 86400
+
+    def __init__(self, base_url=None, handle=None, query='', request_timeout=None):
         addon = self.get_addon()
+        self.request_timeout = request_timeout
         self.base_url = base_url
         self.handle = handle
+        self.folder_path = '{0}{1}'.format(base_url, query)
+        self.upcoming_events = []
         self.addon_path = xbmc.translatePath(addon.getAddonInfo('path'))
         self.addon_profile = xbmc.translatePath(addon.getAddonInfo('profile'))
         self.addon_name = addon.getAddonInfo('id')
@@ -25,7 +40,9 @@ class KodiHelper(object):
         self.logging_prefix = '[%s-%s]' % (self.addon_name, self.addon_version)
         if not xbmcvfs.exists(self.addon_profile):
             xbmcvfs.mkdir(self.addon_profile)
-        self.c = CMore(self.addon_profile, self.get_setting('locale'), True)
+        self.c = self.get_cmore(self.get_setting('locale'))
+        # for data that doesn't depend on the locale, self.c.cache is per locale
+        self.cache = Cache(os.path.join(self.addon_profile, 'cache'))
 
     def get_addon(self):
         """Returns a fresh addon instance."""
@@ -44,6 +61,21 @@ class KodiHelper(object):
     def set_setting(self, key, value):
         return self.get_addon().setSetting(key, value)
 
+    def get_cmore(self, locale):
+        """Return a CMore instance for locale configured from the add-on settings."""
+        cmore = CMore(self.addon_profile, locale, True)
+        cmore.max_staleness = int(self.get_setting('max_staleness') or 0) * 60
+        cmore.hedge_requests = self.get_setting('hedge_requests')
+        cmore.request_timeout = self.request_timeout
+        return cmore
+
+    def sync_locale(self):
+        """Switch to the currently configured locale if it was changed after this instance was created."""
+        locale = self.get_setting('locale')
+        if locale != self.c.locale:
+            self.log('Switching locale to {0}'.format(locale))
+            self.c = self.get_cmore(locale)
+
     def ia_settings(self):
         """Open InputStream Adaptive settings."""
         ia_addon = Addon('inputstream.adaptive')
@@ -65,6 +97,8 @@ class KodiHelper(object):
                 return ret
             else:
                 return None
+        elif dialog_type == 'notification':
+            dialog.notification(heading, message, icon=self.get_addon().getAddonInfo('icon'))
 
     def get_user_input(self, heading, hidden=False):
         keyboard = xbmc.Keyboard('', heading, hidden)
@@ -205,21 +239,84 @@ class KodiHelper(object):
     def eod(self):
         """Tell Kodi that the end of the directory listing is reached."""
         xbmcplugin.endOfDirectory(self.handle)
+        if self.c.stale_requests:
+            # the listing was rendered from cache, let the service check for changes in the background
+            listing = {
+                'locale': self.c.locale,
+                'path': self.folder_path,
+                'requests': self.c.stale_requests
+            }
+            self.notify_service('revalidate', listing)
+        if self.upcoming_events:
+            # the service refreshes the listing when the events go live
+            self.notify_service('schedule', {'path': self.folder_path, 'events': self.upcoming_events})
+
+    def add_upcoming_event(self, video_id, title, start_time):
+        """Track an upcoming event in the current listing. start_time is a timestamp."""
+        self.upcoming_events.append({
+            'video_id': video_id,
+            'title': title,
+            'start': start_time
+        })
+
+    def notify_service(self, message, data):
+        """Send a notification to the add-on service through JSON-RPC."""
+        command = {
+            'jsonrpc': '2.0',
+            'id': 1,
+            'method': 'JSONRPC.NotifyAll',
+            'params': {
+                'sender': self.addon_name,
+                'message': message,
+                'data': data
+            }
+        }
+        xbmc.executeJSONRPC(json.dumps(command))
+
+    def revalidate_listing(self, listing):
+        """Refresh the cached requests behind a listing. Refresh the listing if it's still shown and changed."""
+        self.sync_locale()
+        if listing['locale'] != self.c.locale:
+            return False
+
+        changed = False
+        for request in listing['requests']:
+            try:
+                if self.c.revalidate(request['url'], request['params']):
+                    changed = True
+            except (self.c.CMoreError, requests.exceptions.RequestException) as error:
+                self.log('Failed to revalidate {0}: {1}'.format(request['url'], str(error)))
+        if changed:
+            self.refresh_listing(listing['path'])
+
+        return changed
+
+    def refresh_listing(self, path):
+        """Refresh the listing at path if it's the one currently shown."""
+        if xbmc.getInfoLabel('Container.FolderPath') == path:
+            self.log('Refreshing {0}'.format(path))
+            xbmc.executebuiltin('Container.Refresh')
+            return True
+        else:
+            return False
 
     def play(self, video_id):
-        login_token = self.get_setting('login_token')
-        if not login_token:
-            login_token = self.get_token()
-        try:
-            stream = self.c.get_stream(video_id, login_token=login_token)
-        except self.c.CMoreError as error:
-            if str(error) == 'User is not authenticated':
-                self.log('We have no valid session. Login needed.')
+        stream = self.get_prefetched_stream(video_id)
+        if not stream:
+            login_token = self.get_setting('login_token')
+            if not login_token:
                 login_token = self.get_token()
-                stream = self.c.get_stream(video_id, login_token)
-            else:
-                self.dialog('ok', self.language(30028), str(error))
-                return
+            try:
+                stream = self.c.get_stream(video_id, login_token=login_token)
+            except self.c.CMoreError as error:
+                if str(error) == 'User is not authenticated':
+                    self.log('We have no valid session. Login needed.')
+                    login_token = self.get_token()
+                    stream = self.c.get_stream(video_id, login_token)
+                else:
+                    self.dialog('ok', self.language(30028), str(error))
+                    return
+        self.set_now_playing(video_id, stream['manifestUrl'])
 
         if stream['type'] == 'hls':
             protocol = 'hls'
@@ -230,16 +327,189 @@ class KodiHelper(object):
         else:
             drm = None
 
-        ia_helper = inputstreamhelper.Helper(protocol, drm=drm)
-        if ia_helper.check_inputstream():
+        if self.check_inputstream(protocol, drm):
             playitem = xbmcgui.ListItem(path=stream['manifestUrl'])
             playitem.setProperty('inputstreamaddon', 'inputstream.adaptive')
             playitem.setProperty('inputstream.adaptive.manifest_type', protocol)
             if drm:
                 playitem.setProperty('inputstream.adaptive.license_type', 'com.widevine.alpha')
-                playitem.setProperty('inputstream.adaptive.license_key', stream['license']['castlabsServer'] + '|Content-Type=&x-dt-auth-token=%s|R{SSM}|' % stream['license']['castlabsToken'])
+                playitem.setProperty('inputstream.adaptive.license_key', self.get_license_url(stream['license']['castlabsServer']) + '|Content-Type=&x-dt-auth-token=%s|R{SSM}|' % stream['license']['castlabsToken'])
             xbmcplugin.setResolvedUrl(self.handle, True, listitem=playitem)
 
+    def get_license_url(self, license_server):
+        """Return the URL InputStream Adaptive should send license requests to, the local proxy if it's running."""
+        wv_proxy_port = self.get_setting('wv_proxy_port')
+        if not wv_proxy_port:
+            return license_server
+
+        return 'http://127.0.0.1:{port}/license?{query}'.format(port=wv_proxy_port,
+                                                                query=urllib.urlencode({'server': license_server}))
+
+    def get_inputstream_fingerprint(self, drm):
+        """Return a string identifying the installed InputStream Adaptive version and Widevine CDM files."""
+        try:
+            ia_version = Addon('inputstream.adaptive').getAddonInfo('version')
+        except RuntimeError:  # inputstream.adaptive is not installed
+            return None
+        if not drm:
+            return ia_version
+
+        cdm_files = []
+        cdm_path = xbmc.translatePath('special://home/cdm')
+        if os.path.isdir(cdm_path):
+            for filename in sorted(os.listdir(cdm_path)):
+                file_stat = os.stat(os.path.join(cdm_path, filename))
+                cdm_files.append('{0}:{1}:{2}'.format(filename, file_stat.st_size, int(file_stat.st_mtime)))
+
+        return '{0}|{1}'.format(ia_version, ','.join(cdm_files))
+
+    def check_inputstream(self, protocol, drm=None):
+        """Run the inputstreamhelper checks, skipping them if they passed with the same IA and CDM versions."""
+        cache_key = 'inputstream_{0}_{1}'.format(protocol, drm)
+        fingerprint = self.get_inputstream_fingerprint(drm)
+        if fingerprint and self.cache.get(cache_key) == fingerprint:
+            return True
+
+        ia_helper = inputstreamhelper.Helper(protocol, drm=drm)
+        if ia_helper.check_inputstream():
+            # the check may have installed or updated IA/CDM, so fingerprint again
+            self.cache.set(cache_key, self.get_inputstream_fingerprint(drm))
+            return True
+        else:
+            self.cache.delete(cache_key)
+            return False
+
+    def reset_inputstream_checks(self):
+        """Force the inputstreamhelper checks to run again on the next play."""
+        for protocol in ['hls', 'mpd']:
+            for drm in [None, 'widevine']:
+                self.cache.delete('inputstream_{0}_{1}'.format(protocol, drm))
+
+    def set_episode_queue(self, video_ids):
+        """Remember the episode order of the last listed season so the next episode can be pre-resolved."""
+        self.c.cache.set('episode_queue', [str(x) for x in video_ids])
+
+    def set_now_playing(self, video_id, manifest_url):
+        """Store the currently playing video, its manifest URL and the episode following it in the last listed
+        season."""
+        previous = self.c.cache.get('now_playing')
+        if previous and previous['next_video_id']:
+            # the stream pre-resolved after the previous video has been used by now or won't be
+            self.c.cache.delete('stream_{0}'.format(previous['next_video_id']))
+        episode_queue = self.c.cache.get('episode_queue') or []
+        next_video_id = None
+        if video_id in episode_queue:
+            position = episode_queue.index(video_id)
+            if position + 1 < len(episode_queue):
+                next_video_id = episode_queue[position + 1]
+
+        now_playing = {
+            'video_id': video_id,
+            'manifest_url': manifest_url,
+            'next_video_id': next_video_id,
+            'prefetch_attempted': False
+        }
+        self.c.cache.set('now_playing', now_playing)
+
+    def prefetch_next_episode(self, playing_file):
+        """Resolve the stream of the episode following the one currently playing and cache it for play().
+        Does nothing unless playing_file is the stream of the last C More episode played, and makes a
+        single attempt per episode."""
+        now_playing = self.c.cache.get('now_playing')
+        if not now_playing or not now_playing['next_video_id'] or now_playing['prefetch_attempted']:
+            return False
+        if playing_file != now_playing['manifest_url']:
+            return False  # something else is playing
+        login_token = self.get_setting('login_token')
+        if not login_token:
+            return False  # the login flow needs user interaction, leave it to play()
+
+        next_video_id = now_playing['next_video_id']
+        # a failed attempt isn't retried, play() resolves the stream as usual then
+        now_playing['prefetch_attempted'] = True
+        self.c.cache.set('now_playing', now_playing)
+        self.log('Pre-resolving stream for video id {0}'.format(next_video_id))
+        try:
+            stream = self.c.get_stream(next_video_id, login_token)
+        except (self.c.CMoreError, requests.exceptions.RequestException) as error:
+            self.log('Failed to pre-resolve stream: {0}'.format(str(error)))
+            return False
+        self.c.cache.set('stream_{0}'.format(next_video_id), stream)
+
+        return True
+
+    def get_prefetched_stream(self, video_id):
+        """Return a pre-resolved stream for video_id if one is available. Each stream is only used once."""
+        cache_key = 'stream_{0}'.format(video_id)
+        stream = self.c.cache.get(cache_key, max_age=self.prefetch_max_age)
+        # used or expired, either way it's not needed anymore
+        self.c.cache.delete(cache_key)
+        if stream:
+            self.log('Using pre-resolved stream for video id {0}'.format(video_id))
+
+        return stream
+
+    def sweep_cache(self):
+        """Remove old entries from the per-locale caches. Responses are kept as long as they can be served
+        (pre-resolved streams as long as they can be played), other entries for state_max_age."""
+        cache_folder = os.path.join(self.addon_profile, 'cache')
+        removed = self.cache.sweep(None)  # only leftovers, the inputstream checks are kept
+        max_age = max(int(self.get_setting('max_staleness') or 0) * 60, self.prefetch_max_age)
+        for locale in os.listdir(cache_folder):
+            if not os.path.isdir(os.path.join(cache_folder, locale)):
+                continue
+            cmore = CMore(self.addon_profile, locale)
+            state_keys = cmore.get_state_keys() + ['episode_queue', 'now_playing', 'widgets', 'widgets_requested']
+            removed += cmore.cache.sweep(max_age, dict((key, self.state_max_age) for key in state_keys))
+        self.log('Removed {0} old cache files'.format(removed))
+
+    def get_plugin_url(self, path, **kwargs):
+        """Return a plugin URL in the same format as routing's url_for."""
+        return 'plugin://{addon}/{path}?{query}'.format(addon=self.addon_name, path=path,
+                                                        query=urllib.urlencode(kwargs))
+
+    def widgets_requested(self):
+        """Return True if the widget listings were used within state_max_age."""
+        return bool(self.c.cache.get('widgets_requested', max_age=self.state_max_age))
+
+    def update_widgets(self):
+        """Store a snapshot of the start page carousels for the lightweight widget listings."""
+        widgets = []
+        payloads = AssetPayloads(self.c)
+        # the snapshot is updated on a schedule, so build it from current data rather than cached listings
+        max_staleness = self.c.max_staleness
+        self.c.max_staleness = None
+        try:
+            carousels = self.c.get_carousels('start')
+            for title, params in list(carousels.items())[:self.widget_carousels]:
+                assets = []
+                for param in params:
+                    assets = assets + self.c.get_assets(param)
+                items = [self.get_widget_item(asset, payloads) for asset in assets]
+                widgets.append({
+                    'title': title,
+                    'items': [x for x in items if x][:self.widget_size]
+                })
+        finally:
+            self.c.max_staleness = max_staleness
+        self.c.cache.set('widgets', widgets)
+        self.log('Widget snapshot updated with {0} carousels'.format(len(widgets)))
+
+    def get_widget_item(self, asset, payloads):
+        """Return the title, art and URL of an asset for the widget snapshot."""
+        if asset['type'] == 'series':
+            payload = payloads.get(asset)
+            url = self.get_plugin_url('list_seasons', asset=json.dumps(payload['series']))
+            return {'id': asset['brand_id'], 'title': payload['title'], 'art': payload['art'], 'url': url,
+                    'playable': False}
+        elif asset['type'] in ['movie', 'episode', 'unscripted_episode']:
+            payload = payloads.get(asset)
+            url = self.get_plugin_url('play', video_id=asset['video_id'])
+            return {'id': asset['video_id'], 'title': payload['title'], 'art': payload['art'], 'url': url,
+                    'playable': True}
+        else:  # sport events change state over time, they're better off in the full listings
+            return None
+
     def get_as_bool(self, string):
         if string == 'true':
             return True
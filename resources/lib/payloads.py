@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Per-asset list item payloads (title, info labels and art) for the C More listings
+"""
+import time
+
+
+class AssetPayloads(object):
+    """Builds the list item payload of an asset: the list title, info labels and art. Everything in a
+    payload is plain data, so the listings and tools can use it without Kodi."""
+
+    def __init__(self, cmore):
+        self.c = cmore
+        self.info_locale = self.c.locale.split('_')[0]
+        self.builders = {
+            'movie': self.build_movie,
+            'series': self.build_series,
+            'episode': self.build_episode,
+            'unscripted_episode': self.build_episode,
+            'sport': self.build_sport
+        }
+
+    def get(self, asset):
+        """Return the payload of asset or None if the asset type isn't supported."""
+        if asset['type'] in self.builders:
+            return self.builders[asset['type']](asset)
+        else:
+            return None
+
+    def get_localized(self, asset, field):
+        return asset['{field}_{locale}'.format(field=field, locale=self.info_locale)]
+
+    def build_movie(self, asset):
+        info = {
+            'mediatype': 'movie',
+            'title': self.get_localized(asset, 'title'),
+            'originaltitle': asset['original_title']['text'],
+            'genre': asset.get('genre_description_{locale}'.format(locale=self.info_locale)),
+            'plot': self.get_localized(asset, 'description_extended'),
+            'plotoutline': self.get_localized(asset, 'description_short'),
+            'country': asset['country'],
+            'cast': [x['name'] for x in asset['credits'] if x['function'] == 'actor'],
+            'director': [x['name'] for x in asset['credits'] if x['function'] == 'director'],
+            'year': int(asset['production_year']),
+            'duration': int(asset['duration']),
+            'studio': asset['studio']
+        }
+        return {'title': info['title'], 'info': info, 'art': self.c.get_art(asset)}
+
+    def build_series(self, asset):
+        seasons_key = 'seasons_cmore_{site}'.format(site=self.c.locale_suffix)
+        info = {
+            'mediatype': 'tvshow',
+            'title': self.get_localized(asset, 'title'),
+            'tvshowtitle': self.get_localized(asset, 'title'),
+            'genre': asset.get('genre_description_{locale}'.format(locale=self.info_locale)),
+            'plot': self.get_localized(asset, 'description_extended'),
+            'plotoutline': self.get_localized(asset, 'description_short'),
+            'country': asset['country'],
+            'cast': [x['name'] for x in asset['credits'] if x['function'] == 'actor'],
+            'director': [x['name'] for x in asset['credits'] if x['function'] == 'director'],
+            'year': int(asset['production_year']),
+            'studio': asset['studio'],
+            'season': len(asset[seasons_key])
+        }
+        # list_seasons only needs the brand and its seasons
+        series = {'brand_id': asset['brand_id'], seasons_key: asset[seasons_key]}
+        return {'title': info['title'], 'info': info, 'art': self.c.get_art(asset), 'series': series}
+
+    def build_episode(self, asset):
+        info = {
+            'mediatype': 'episode',
+            'title': self.get_localized(asset, 'title').replace(':', ''),
+            'tvshowtitle': self.get_localized(asset['brand'], 'title'),
+            'genre': asset.get('genre_description_{locale}'.format(locale=self.info_locale)),
+            'plot': self.get_localized(asset, 'description_extended'),
+            'country': asset['country'],
+            'cast': [x['name'] for x in asset['credits'] if x['function'] == 'actor'],
+            'director': [x['name'] for x in asset['credits'] if x['function'] == 'director'],
+            'year': int(asset['production_year']),
+            'duration': int(asset['duration']),
+            'studio': asset['brand']['studio'],
+            'season': asset['season']['season_number'],
+            'episode': asset['episode_number']
+        }
+        title = u'[B]S{season:02d}E{episode:02d}[/B]: {title}'.format(season=int(info['season']),
+                                                                    episode=int(info['episode']),
+                                                                    title=info['title'])
+        return {'title': title, 'info': info, 'art': self.c.get_art(asset)}
+
+    def build_sport(self, asset):
+        """The live/upcoming state depends on the time of rendering, so the payload holds the start time
+        (as a timestamp) and leaves the list title to the listing."""
+        info = {
+            'mediatype': 'video',
+            'originaltitle': asset['original_title']['text'],
+            'title': self.get_localized(asset, 'title'),
+            'genre': self.get_localized(asset, 'league'),
+            'plot': self.get_localized(asset, 'description_short'),
+            'year': int(asset['production_year']),
+            'cast': [x['name'] for x in asset['credits']]
+        }
+        start_time = self.c.parse_datetime(asset['events'][0]['start_time'])
+        return {
+            'title': info['title'],
+            'info': info,
+            'art': self.c.get_art(asset),
+            'start_time': time.mktime(start_time.timetuple())
+        }
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+GraphQL documents used by the C More API client, trimmed to the fields the add-on reads
+"""
+
+LOGIN = """mutation Login($username: String!, $password: String, $site: String) {
+  login(credentials: {username: $username, password: $password}, site: $site) {
+    session {
+      token
+    }
+  }
+}
+"""
+
+LOGIN_TVE = """mutation LoginTve($operatorName: String!, $username: String!, $password: String, $countryCode: String!) {
+  login(tveCredentials: {operator: $operatorName, username: $username, password: $password, countryCode: $countryCode}) {
+    session {
+      token
+    }
+  }
+}
+"""
+
+EPG = """query EpgQuery($date: String!) {
+  epg(date: $date) {
+    days {
+      channels {
+        asset {
+          id
+        }
+        title
+        schedules {
+          calendarDate
+          program {
+            title
+            seasonNumber
+            episodeNumber
+            duration
+            shortSynopsis
+            imageId
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+# operation name: (document, whether the response may be requested with GET and cached)
+QUERIES = {
+    'Login': (LOGIN, False),
+    'LoginTve': (LOGIN_TVE, False),
+    'EpgQuery': (EPG, True)
+}
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight listings for home screen widgets, served from the snapshot kept by the service.
+Deliberately avoids importing addon/kodihelper so a widget refresh needs no config load or API calls.
+"""
+import os
+import sys
+from urlparse import parse_qs
+
+import xbmc
+import xbmcgui
+import xbmcplugin
+from xbmcaddon import Addon
+
+from cache import Cache
+
+
+def get_widgets():
+    addon = Addon()
+    addon_profile = xbmc.translatePath(addon.getAddonInfo('profile'))
+    # the same per-locale cache folder the CMore instance in the service writes to
+    cache = Cache(os.path.join(addon_profile, 'cache', addon.getSetting('locale')))
+    # the service only keeps the snapshot up to date while the widgets are in use
+    cache.set('widgets_requested', True)
+    return cache.get('widgets') or []
+
+
+def run():
+    base_url = sys.argv[0]
+    handle = int(sys.argv[1])
+    args = parse_qs(sys.argv[2][1:])
+    widgets = get_widgets()
+
+    if 'carousel' in args:
+        try:
+            items = widgets[int(args['carousel'][0])]['items']
+        except (IndexError, ValueError):
+            items = []
+        listing = []
+        for item in items:
+            listitem = xbmcgui.ListItem(label=item['title'])
+            listitem.setArt(item['art'])
+            listitem.setInfo('video', {'title': item['title']})
+            if item['playable']:
+                listitem.setProperty('IsPlayable', 'true')
+            listing.append((item['url'], listitem, not item['playable']))
+        xbmcplugin.setContent(handle, 'videos')
+    else:
+        listing = []
+        for index, widget in enumerate(widgets):
+            url = '{0}?carousel={1}'.format(base_url, index)
+            listing.append((url, xbmcgui.ListItem(label=widget['title']), True))
+
+    xbmcplugin.addDirectoryItems(handle, listing, len(listing))
+    xbmcplugin.endOfDirectory(handle)
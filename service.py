@@ -3,12 +3,14 @@
 # Created on: 13.01.2017
 # License: MIT https://goo.gl/5bMj3H
 
+import json
+import time
+import heapq
 import threading
-import SocketServer
 import socket
-from xbmc import Monitor
+from xbmc import Monitor, Player
 from resources.lib.kodihelper import KodiHelper
-from resources.lib.WidevineHTTPRequestHandler import WidevineHTTPRequestHandler
+from resources.lib.WidevineHTTPRequestHandler import WidevineHTTPRequestHandler, WidevineProxyServer
 
 # helper function to select an unused port on the host machine
 def select_unused_port():
@@ -18,35 +20,155 @@ def select_unused_port():
     sock.close()
     return port
 
-helper = KodiHelper()
+# start pre-resolving the next episode when this many seconds of playback remain
+PREFETCH_THRESHOLD = 300
+# seconds between widget snapshot updates
+WIDGET_UPDATE_INTERVAL = 1800
+# seconds between removals of old cache entries
+CACHE_SWEEP_INTERVAL = 3600
+# seconds to wait for API responses, a stalled connection mustn't hold up the main loop
+REQUEST_TIMEOUT = 10
+
+
+class EventTimeline(object):
+    """Upcoming sport events from the rendered listings, ordered by start time."""
+
+    def __init__(self):
+        self.events = []
+        self.tracked = set()
+
+    def add(self, path, events):
+        for event in events:
+            key = (path, event['video_id'])
+            if key not in self.tracked and event['start'] > time.time():
+                self.tracked.add(key)
+                heapq.heappush(self.events, (event['start'], event['video_id'], event['title'], path))
+
+    def seconds_until_next(self):
+        if self.events:
+            return self.events[0][0] - time.time()
+        else:
+            return None
+
+    def pop_started(self):
+        started = []
+        while self.events and self.events[0][0] <= time.time():
+            start, video_id, title, path = heapq.heappop(self.events)
+            self.tracked.discard((path, video_id))
+            started.append({'video_id': video_id, 'title': title, 'path': path})
+        return started
+
+
+class CMoreMonitor(Monitor):
+    def onNotification(self, sender, method, data):
+        if sender != helper.addon_name:
+            return
+        if method == 'Other.revalidate':
+            helper.revalidate_listing(json.loads(data))
+        elif method == 'Other.schedule':
+            schedule = json.loads(data)
+            timeline.add(schedule['path'], schedule['events'])
+
+
+class CMorePlayer(Player):
+    def onPlayBackError(self):
+        # a failed playback may mean the cached inputstream checks are no longer valid
+        helper.reset_inputstream_checks()
+
+
+# pre-resolve the stream of the next episode in the season while the current one finishes
+def prefetch_next_episode(player):
+    if not player.isPlayingVideo():
+        return
+    try:
+        playing_file = player.getPlayingFile()
+        remaining = player.getTotalTime() - player.getTime()
+    except RuntimeError:  # playback stopped between the checks
+        return
+    if 0 < remaining <= PREFETCH_THRESHOLD:
+        helper.sync_locale()
+        helper.prefetch_next_episode(playing_file)
+
+
+# refresh the listings of events that just went live, or tell the user about them
+def handle_started_events(events):
+    for path in set(x['path'] for x in events):
+        helper.refresh_listing(path)
+    if helper.get_setting('sports_notifications'):
+        # the timeline tracks events per listing, an event shown in several listings is announced once
+        titles = dict((x['video_id'], x['title']) for x in events)
+        for title in titles.values():
+            helper.dialog('notification', helper.language(30041), title)
+
+
+# keep the add-on profile from growing with cache entries nobody will use
+def sweep_cache():
+    helper.sync_locale()
+    try:
+        helper.sweep_cache()
+    except (IOError, OSError) as error:
+        helper.log('Cache sweep failed: {0}'.format(str(error)))
+
+
+# keep the snapshot the widget listings are served from up to date
+def update_widgets():
+    helper.sync_locale()
+    if not helper.widgets_requested():
+        return False  # nothing shows the snapshot, don't load the API for it
+    try:
+        helper.update_widgets()
+    except Exception as error:  # don't let a failed update take the service down
+        helper.log('Widget snapshot update failed: {0}'.format(str(error)))
+    return True
+
+
+helper = KodiHelper(request_timeout=REQUEST_TIMEOUT)
+timeline = EventTimeline()
 
 # pick & store a port for the proxy service
 wv_proxy_port = select_unused_port()
 helper.set_setting('wv_proxy_port', str(wv_proxy_port))
 helper.log('Port {0} selected'.format(str(wv_proxy_port)))
 
-# server defaults
-SocketServer.TCPServer.allow_reuse_address = True
-# configure the proxy server
-wv_proxy = SocketServer.TCPServer(('127.0.0.1', wv_proxy_port), WidevineHTTPRequestHandler)
-wv_proxy.server_activate()
+# configure the proxy server, license requests are handled in their own threads
+wv_proxy = WidevineProxyServer(('127.0.0.1', wv_proxy_port), WidevineHTTPRequestHandler, log=helper.log)
 wv_proxy.timeout = 1
 
 if __name__ == '__main__':
-    monitor = Monitor()
+    monitor = CMoreMonitor()
+    player = CMorePlayer()
     # start thread for proxy server
     proxy_thread = threading.Thread(target=wv_proxy.serve_forever)
     proxy_thread.daemon = True
     proxy_thread.start()
 
     # kill the services if kodi monitor tells us to
+    last_widget_update = 0
+    widget_locale = None
+    last_cache_sweep = 0
     while not monitor.abortRequested():
-        if monitor.waitForAbort(5):
+        # wake up right when the next tracked event starts
+        timeout = 5
+        next_event = timeline.seconds_until_next()
+        if next_event is not None:
+            timeout = max(0.1, min(timeout, next_event))
+        if monitor.waitForAbort(timeout):
             wv_proxy.shutdown()
             break
+        started_events = timeline.pop_started()
+        if started_events:
+            handle_started_events(started_events)
+        prefetch_next_episode(player)
+        if time.time() - last_cache_sweep > CACHE_SWEEP_INTERVAL:
+            sweep_cache()
+            last_cache_sweep = time.time()
+        widgets_outdated = time.time() - last_widget_update > WIDGET_UPDATE_INTERVAL
+        if (widgets_outdated or helper.get_setting('locale') != widget_locale) and not player.isPlayingVideo():
+            if update_widgets():
+                last_widget_update = time.time()
+                widget_locale = helper.c.locale
 
     # wv-proxy service shutdown sequence
     wv_proxy.server_close()
-    wv_proxy.socket.close()
-    wv_proxy.shutdown()
+    helper.set_setting('wv_proxy_port', '')
     helper.log('wv-proxy stopped')
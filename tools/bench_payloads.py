@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the per-asset list item payloads.
+
+Measures the cost per asset of turning search API assets into what list_assets hands to add_item (list title,
+info labels, art and the list_seasons argument of series). The Kodi calls (ListItem, url_for) cost the same
+in every variant and are left out.
+
+- before: the add_movie/add_series/add_episode/add_sport transformation of the listings before AssetPayloads
+- after: AssetPayloads.get for every asset
+
+A payload cache keyed by asset id, response fetch time and locale was measured as well. On python 2.7, the
+add-on's runtime, it was on par with AssetPayloads when warm (36-41 us/asset against 27-42) and 2-3 times
+slower on the first render of a response, so payloads are built on every render.
+
+Uses synthetic assets shaped like the search API's and needs no network access.
+
+    python tools/bench_payloads.py --assets 100 --rounds 20
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'resources', 'lib'))
+from cmore import CMore  # noqa: E402
+from payloads import AssetPayloads  # noqa: E402
+
+LOCALE = 'sv_SE'
+INFO_LOCALE = 'sv'
+ASSET_TYPES = ['series', 'episode', 'movie', 'sport']
+
+
+def make_asset(index):
+    """Return a synthetic asset with roughly the size of a real one, cycling through the asset types."""
+    images = {
+        'url': 'https://img-cdn-cmore.b17g.services/{0}/default.img'.format(index),
+        'localizations': [{'language': x, 'url': 'https://img-cdn-cmore.b17g.services/{0}/{1}.img'.format(index, x)}
+                          for x in ['da_DK', 'nb_NO', 'sv_SE']]
+    }
+    asset = {
+        'type': ASSET_TYPES[index % len(ASSET_TYPES)],
+        'video_id': str(1000 + index),
+        'brand_id': str(500 + index),
+        'brand': {'title_sv': u'Serien', 'studio': 'Studio'},
+        'season': {'season_number': 2},
+        'episode_number': index + 1,
+        'original_title': {'text': 'Title {0}'.format(index)},
+        'country': ['SE'],
+        'studio': 'Studio',
+        'production_year': '2017',
+        'duration': '2700',
+        'poster': images,
+        'landscape': images,
+        'credits': [{'name': 'Person {0}'.format(x), 'function': ['actor', 'director'][x % 5 == 0]} for x in range(25)],
+        'seasons_cmore_se': [1, 2],
+        'events': [{'start_time': '2017-12-{0:02d}T20:00:00Z'.format(index % 28 + 1)}]
+    }
+    for language in ['sv', 'da', 'nb', 'fi', 'en']:
+        asset['title_' + language] = u'Titel {0}: Öppningen'.format(index)
+        asset['description_short_' + language] = u'En kort beskrivning. ' * 5
+        asset['description_extended_' + language] = u'En längre beskrivning av avsnittet. ' * 20
+        asset['genre_description_' + language] = u'Drama'
+        asset['league_' + language] = u'Allsvenskan'
+    return asset
+
+
+def coloring(text, meaning):
+    """coloring from addon.py."""
+    if meaning == 'live':
+        color = 'FF03F12F'
+    elif meaning == 'archive':
+        color = 'FFFF0EE0'
+    elif meaning == 'upcoming':
+        color = 'FFF16C00'
+
+    colored_text = '[COLOR=%s]%s[/COLOR]' % (color, text)
+    return colored_text
+
+
+def sport_status(asset, asset_date):
+    """The render time part of add_sport, the same before and after AssetPayloads."""
+    if datetime.now().date() == asset_date.date():
+        start_time = u'Today {0}'.format(asset_date.strftime('%H:%M'))
+    else:
+        start_time = asset_date.strftime('%Y-%m-%d %H:%M')
+    if asset_date > datetime.now():
+        event_status = 'upcoming'
+    elif 'live_event_end' in asset:
+        event_status = 'archive'
+    else:
+        event_status = 'live'
+    return start_time, event_status
+
+
+def legacy_movie(cmore, asset):
+    info = {
+        'mediatype': 'movie',
+        'title': asset['title_{locale}'.format(locale=INFO_LOCALE)],
+        'originaltitle': asset['original_title']['text'],
+        'genre': asset.get('genre_description_{locale}'.format(locale=INFO_LOCALE)),
+        'plot': asset['description_extended_{locale}'.format(locale=INFO_LOCALE)],
+        'plotoutline': asset['description_short_{locale}'.format(locale=INFO_LOCALE)],
+        'country': asset['country'],
+        'cast': [x['name'] for x in asset['credits'] if x['function'] == 'actor'],
+        'director': [x['name'] for x in asset['credits'] if x['function'] == 'director'],
+        'year': int(asset['production_year']),
+        'duration': int(asset['duration']),
+        'studio': asset['studio']
+    }
+    return info['title'], info, cmore.get_art(asset)
+
+
+def legacy_series(cmore, asset):
+    info = {
+        'mediatype': 'tvshow',
+        'title': asset['title_{locale}'.format(locale=INFO_LOCALE)],
+        'tvshowtitle': asset['title_{locale}'.format(locale=INFO_LOCALE)],
+        'genre': asset.get('genre_description_{locale}'.format(locale=INFO_LOCALE)),
+        'plot': asset['description_extended_{locale}'.format(locale=INFO_LOCALE)],
+        'plotoutline': asset['description_short_{locale}'.format(locale=INFO_LOCALE)],
+        'country': asset['country'],
+        'cast': [x['name'] for x in asset['credits'] if x['function'] == 'actor'],
+        'director': [x['name'] for x in asset['credits'] if x['function'] == 'director'],
+        'year': int(asset['production_year']),
+        'studio': asset['studio'],
+        'season': len(asset['seasons_cmore_{site}'.format(site=cmore.locale_suffix)])
+    }
+    json.dumps(asset)  # the list_seasons argument
+    return info['title'], info, cmore.get_art(asset)
+
+
+def legacy_sport(cmore, asset):
+    asset_date = cmore.parse_datetime(asset['events'][0]['start_time'])
+    start_time, event_status = sport_status(asset, asset_date)
+    info = {
+        'mediatype': 'video',
+        'originaltitle': asset['original_title']['text'],
+        'title': asset['title_{locale}'.format(locale=INFO_LOCALE)],
+        'genre': asset['league_{locale}'.format(locale=INFO_LOCALE)],
+        'plot': asset['description_short_{locale}'.format(locale=INFO_LOCALE)],
+        'year': int(asset['production_year']),
+        'cast': [x['name'] for x in asset['credits']]
+    }
+    list_title = '[B]{0}:[/B] {1}'.format(coloring(start_time, event_status).encode('utf-8'),
+                                          info['title'].encode('utf-8'))
+    return list_title, info, cmore.get_art(asset)
+
+
+def legacy_episode(cmore, asset):
+    info = {
+        'mediatype': 'episode',
+        'title': asset['title_{locale}'.format(locale=INFO_LOCALE)].replace(':', ''),
+        'tvshowtitle': asset['brand']['title_{locale}'.format(locale=INFO_LOCALE)],
+        'genre': asset.get('genre_description_{locale}'.format(locale=INFO_LOCALE)),
+        'plot': asset['description_extended_{locale}'.format(locale=INFO_LOCALE)],
+        'country': asset['country'],
+        'cast': [x['name'] for x in asset['credits'] if x['function'] == 'actor'],
+        'director': [x['name'] for x in asset['credits'] if x['function'] == 'director'],
+        'year': int(asset['production_year']),
+        'duration': int(asset['duration']),
+        'studio': asset['brand']['studio'],
+        'season': asset['season']['season_number'],
+        'episode': asset['episode_number']
+    }
+    return legacy_episode_list_title(asset), info, cmore.get_art(asset)
+
+
+def legacy_episode_list_title(asset):
+    season = asset['season']['season_number']
+    episode = asset['episode_number']
+    title = asset['title_{locale}'.format(locale=INFO_LOCALE)].replace(':', '')
+    if int(season) <= 9:
+        season_format = '0' + str(season)
+    else:
+        season_format = str(season)
+    if int(episode) <= 9:
+        episode_format = '0' + str(episode)
+    else:
+        episode_format = str(episode)
+
+    return '[B]S{season_format}E{episode_format}[/B]: {title}'.format(season_format=season_format,
+                                                                      episode_format=episode_format,
+                                                                      title=title.encode('utf-8'))
+
+
+LEGACY_ROUTING = {
+    'movie': legacy_movie,
+    'series': legacy_series,
+    'episode': legacy_episode,
+    'sport': legacy_sport
+}
+
+
+def render(asset, payload):
+    """The per-asset work list_assets still does with a payload."""
+    if asset['type'] == 'series':
+        json.dumps(payload['series'])  # the list_seasons argument
+    elif asset['type'] == 'sport':
+        asset_date = datetime.fromtimestamp(payload['start_time'])
+        start_time, event_status = sport_status(asset, asset_date)
+        u'[B]{0}:[/B] {1}'.format(coloring(start_time, event_status), payload['title'])
+
+
+def bench(func, rounds, assets):
+    """Return the median cost per asset of a render in microseconds."""
+    elapsed = []
+    for _ in range(rounds):
+        start_time = time.time()
+        func()
+        elapsed.append(time.time() - start_time)
+    return sorted(elapsed)[len(elapsed) // 2] / assets * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the per-asset cost of rendering list item payloads.')
+    parser.add_argument('--assets', type=int, default=100, help='assets per listing')
+    parser.add_argument('--rounds', type=int, default=20, help='renders of the listing per measurement')
+    args = parser.parse_args()
+
+    settings_folder = tempfile.mkdtemp(prefix='cmore-bench-')
+    try:
+        config = {
+            'data': {
+                'settings': {'currentAppVersion': '3.14.1'},
+                'bootstrap': {'suggested_site': {'locale': LOCALE}},
+                'links': {'imageProxy': 'https://imageproxy.b17g.services/convert'}
+            }
+        }
+        with open(os.path.join(settings_folder, 'configuration_{0}.json'.format(LOCALE)), 'w') as fh_config:
+            fh_config.write(json.dumps(config))
+        cmore = CMore(settings_folder, LOCALE)
+        assets = [make_asset(x) for x in range(args.assets)]
+        payloads = AssetPayloads(cmore)
+
+        def before():
+            for asset in assets:
+                LEGACY_ROUTING[asset['type']](cmore, asset)
+
+        def after():
+            for asset in assets:
+                render(asset, payloads.get(asset))
+
+        results = [
+            ('before', bench(before, args.rounds, args.assets)),
+            ('after', bench(after, args.rounds, args.assets))
+        ]
+    finally:
+        shutil.rmtree(settings_folder, ignore_errors=True)
+
+    print('{0} assets per listing, {1} renders, python {2}'.format(args.assets, args.rounds, sys.version.split()[0]))
+    for name, cost in results:
+        print('{0:<8}{1:8.1f} us/asset'.format(name, cost))
+
+
+if __name__ == '__main__':
+    main()
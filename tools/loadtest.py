@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Load test for the C More API client.
+
+Starts a local stub of the C More backend and lets a number of simulated Kodi clients, each with its own
+CMore instance and settings folder, run browse/search/tv/play scripts against it concurrently. Reports
+throughput, latency percentiles, upstream requests per user action and cache effectiveness.
+
+Run it from the add-on root with the add-on's dependencies (requests, iso8601) available:
+
+    python tools/loadtest.py --users 20 --iterations 25 --backend-latency 50
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:  # python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'resources', 'lib'))
+from cmore import CMore  # noqa: E402
+
+USER_HEADER = 'X-Loadtest-User'
+SCRIPTS = {
+    'browse': 6,
+    'search': 2,
+    'tv': 1,
+    'play': 2
+}
+
+
+class StubCatalogue(object):
+    """Deterministic fake catalogue served by the stub backend."""
+
+    def __init__(self, carousels=8, carousel_size=20):
+        self.carousels = []
+        for carousel in range(carousels):
+            targets = []
+            for item in range(carousel_size):
+                if item % 3 == 0:
+                    targets.append({'type': 'series', 'id': 'b{0}-{1}'.format(carousel, item)})
+                else:
+                    targets.append({'type': 'movie', 'videoId': 'v{0}-{1}'.format(carousel, item)})
+            self.carousels.append({'attributes': {'headline': 'Carousel {0}'.format(carousel)}, 'targets': targets})
+        self.video_ids = [x['videoId'] for carousel in self.carousels for x in carousel['targets'] if 'videoId' in x]
+
+    def page(self):
+        return {
+            'data': {
+                'containers': {
+                    'section_containers': self.carousels,
+                    'page_link_container': {
+                        'pageLinks': [{'headline': 'Genre', 'id': 'genre', 'namespace': 'page'}]
+                    }
+                }
+            }
+        }
+
+    @staticmethod
+    def assets(ids):
+        return {'assets': [{'video_id': x, 'type': 'movie', 'title_sv': x} for x in ids]}
+
+    def channels(self):
+        channel = {
+            'asset': {'id': self.video_ids[0]},
+            'title': 'Channel',
+            'schedules': [{'calendarDate': '2017-12-29T20:00:00Z', 'program': {'title': 'Program'}}]
+        }
+        return {'data': {'epg': {'days': [{'channels': [channel] * 10}]}}}
+
+
+class StubBackend(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, slow_requests=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubRequestHandler)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server_address[1])
+        self.latency = latency
+        self.slow_requests = slow_requests
+        self.catalogue = StubCatalogue()
+        self.persisted_queries = set()
+        self.lock = threading.Lock()
+        self.requests_per_user = defaultdict(int)
+        self.requests_per_endpoint = defaultdict(int)
+
+    def count(self, user, endpoint):
+        with self.lock:
+            self.requests_per_user[user] += 1
+            self.requests_per_endpoint[endpoint] += 1
+
+    def get_user_requests(self, user):
+        with self.lock:
+            return self.requests_per_user[user]
+
+    def configuration(self, locale):
+        links = {
+            'pageAPI': self.url + '/page/',
+            'bbSearchAPI': self.url + '/bbsearch',
+            'graphqlAPI': self.url + '/graphql',
+            'accountDelta': self.url + '/graphql',
+            'accountJune': self.url + '/graphql',
+            'tveAPI': self.url + '/tve/',
+            'imageProxy': self.url + '/image'
+        }
+        return {
+            'data': {
+                'settings': {'currentAppVersion': '3.14.1'},
+                'bootstrap': {'suggested_site': {'locale': locale}},
+                'links': links
+            }
+        }
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((key, value[0]) for key, value in parse_qs(url.query).items())
+        self.count(url.path)
+        if url.path == '/configuration':
+            self.reply(self.server.configuration(query['locale']))
+        elif url.path.startswith('/page/'):
+            self.reply(self.server.catalogue.page())
+        elif url.path == '/bbsearch/search':
+            ids = (query.get('video_ids') or query.get('brand_ids') or query.get('q', 'x')).split(',')
+            self.reply(self.server.catalogue.assets(ids))
+        elif url.path == '/graphql':
+            self.graphql({'extensions': json.loads(query.get('extensions', '{}'))})
+        elif url.path == '/init':
+            self.reply({
+                'config': {
+                    'envPlaybackApi': self.server.url + '/playback',
+                    'envPlaybackDevice': 'android',
+                    'envPlaybackProtocol': 'dash',
+                    'envPlaybackDrm': 'widevine'
+                }
+            })
+        elif url.path.startswith('/playback/asset/'):
+            self.reply({'mediaUri': '/media/' + url.path.split('/')[-1]})
+        elif url.path.startswith('/playback/media/'):
+            self.reply({
+                'playbackItem': {
+                    'type': 'dash',
+                    'manifestUrl': self.server.url + '/manifest.mpd',
+                    'license': {'castlabsServer': self.server.url + '/license', 'castlabsToken': 'token'}
+                }
+            })
+        else:
+            self.reply({'error': {'message': 'Not found'}}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self.count(url.path)
+        self.graphql(json.loads(self.rfile.read(int(self.headers['content-length']))))
+
+    def graphql(self, body):
+        query_hash = body.get('extensions', {}).get('persistedQuery', {}).get('sha256Hash')
+        if query_hash and 'query' not in body:
+            if query_hash not in self.server.persisted_queries:
+                return self.reply({'errors': [{'message': 'PersistedQueryNotFound'}]})
+        elif query_hash:
+            self.server.persisted_queries.add(query_hash)
+        if body.get('operationName', '').startswith('Login'):
+            self.reply({'data': {'login': {'session': {'token': 'token'}}}})
+        else:
+            self.reply(self.server.catalogue.channels())
+
+    def count(self, path):
+        if self.server.latency:
+            latency = self.server.latency
+            if random.random() < self.server.slow_requests:
+                latency *= 10
+            time.sleep(latency)
+        endpoint = '/'.join(path.split('/')[:2])
+        self.server.count(self.headers.get(USER_HEADER), endpoint)
+
+    def reply(self, data, status_code=200):
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SimulatedClient(threading.Thread):
+    """A Kodi installation running scripted user actions through its own CMore instance."""
+
+    def __init__(self, user_id, backend, settings_folder, args, results):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.user_id = str(user_id)
+        self.backend = backend
+        self.settings_folder = settings_folder
+        self.args = args
+        self.results = results
+        self.random = random.Random(args.seed + user_id)
+        self.cmore = None
+        self.login_token = None
+
+    def run(self):
+        self.action('startup', self.startup)
+        if not self.cmore:
+            return
+        scripts = [script for script, weight in SCRIPTS.items() for _ in range(weight)]
+        for _ in range(self.args.iterations):
+            script = self.random.choice(scripts)
+            self.action(script, getattr(self, script))
+            if self.args.think_time:
+                time.sleep(self.random.uniform(0, self.args.think_time))
+        self.results.add_cache_stats(self.cmore)
+        self.cmore.http_session.close()
+
+    def action(self, name, func):
+        requests_before = self.backend.get_user_requests(self.user_id)
+        start_time = time.time()
+        error = None
+        try:
+            func()
+        except Exception as exception:  # a load test reports failures instead of stopping
+            error = str(exception)
+        latency = time.time() - start_time
+        upstream_requests = self.backend.get_user_requests(self.user_id) - requests_before
+        self.results.add(name, latency, upstream_requests, error)
+
+    def startup(self):
+        self.cmore = CMore(self.settings_folder, self.args.locale)
+        # tag the session so the backend attributes its requests to this client
+        self.cmore.http_session.headers[USER_HEADER] = self.user_id
+        self.cmore.max_staleness = self.args.max_staleness
+        self.cmore.hedge_requests = self.args.hedge_requests
+        # the config is loaded on first use, load it here so its download counts against startup
+        self.cmore.config
+
+    def browse(self):
+        carousels = self.cmore.get_carousels('start')
+        for params in self.random.sample(list(carousels.values()), 2):
+            for param in params:
+                self.cmore.get_assets(param)
+
+    def search(self):
+        self.cmore.get_assets({'q': self.random.choice(['film', 'serie', 'sport', 'barn']), 'type': 'movie,series'})
+
+    def tv(self):
+        self.cmore.get_channels()
+
+    def play(self):
+        if not self.login_token:
+            credentials = self.cmore.login('user{0}'.format(self.user_id), 'password')
+            self.login_token = credentials['data']['login']['session']['token']
+        self.cmore.get_stream(self.random.choice(self.backend.catalogue.video_ids), self.login_token)
+
+
+class Results(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.upstream_requests = defaultdict(int)
+        self.errors = defaultdict(list)
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def add(self, action, latency, upstream_requests, error):
+        with self.lock:
+            self.latencies[action].append(latency)
+            self.upstream_requests[action] += upstream_requests
+            if error:
+                self.errors[action].append(error)
+
+    def add_cache_stats(self, cmore):
+        with self.lock:
+            self.cache_hits += cmore.cache_hits
+            self.cache_misses += cmore.cache_misses
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of values."""
+    ordered = sorted(values)
+    index = max(0, int(round(percent / 100.0 * len(ordered))) - 1)
+    return ordered[index]
+
+
+def report(results, backend, duration):
+    actions = sum(len(x) for x in results.latencies.values())
+    print('{0} actions in {1:.2f} s, {2:.1f} actions/s'.format(actions, duration, actions / duration))
+    print('')
+    print('{0:<10}{1:>8}{2:>10}{3:>10}{4:>10}{5:>10}{6:>14}{7:>8}'.format(
+        'action', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'requests/act', 'errors'))
+    amplification = {}
+    for action in sorted(results.latencies):
+        latencies = results.latencies[action]
+        amplification[action] = float(results.upstream_requests[action]) / len(latencies)
+        print('{0:<10}{1:>8}{2:>10.1f}{3:>10.1f}{4:>10.1f}{5:>10.1f}{6:>14.2f}{7:>8}'.format(
+            action, len(latencies), percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000, max(latencies) * 1000, amplification[action],
+            len(results.errors[action])))
+    print('')
+    lookups = results.cache_hits + results.cache_misses
+    if lookups:
+        print('cache: {0} hits, {1} misses, {2:.1f}% hit ratio'.format(
+            results.cache_hits, results.cache_misses, 100.0 * results.cache_hits / lookups))
+    print('upstream requests per endpoint: {0}'.format(
+        ', '.join('{0}={1}'.format(x, y) for x, y in sorted(backend.requests_per_endpoint.items()))))
+    for action, errors in sorted(results.errors.items()):
+        if errors:
+            print('first {0} error: {1}'.format(action, errors[0]))
+
+    return amplification
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate concurrent Kodi clients against a stub C More backend.')
+    parser.add_argument('--users', type=int, default=10, help='number of concurrent simulated clients')
+    parser.add_argument('--iterations', type=int, default=20, help='scripted actions per client')
+    parser.add_argument('--locale', default='sv_SE', choices=['sv_SE', 'da_DK', 'nb_NO'])
+    parser.add_argument('--backend-latency', type=float, default=0, help='stub backend latency in ms')
+    parser.add_argument('--slow-requests', type=float, default=0,
+                        help='fraction of backend requests that take ten times the backend latency')
+    parser.add_argument('--hedge-requests', action='store_true', help='hedge slow playback requests')
+    parser.add_argument('--think-time', type=float, default=0, help='max pause between actions in s')
+    parser.add_argument('--max-staleness', type=int, default=1800,
+                        help='seconds cached listings are served for, 0 disables the cache')
+    parser.add_argument('--max-requests-per-action', type=float, default=None,
+                        help='exit with status 1 if any action averages more upstream requests than this')
+    parser.add_argument('--shared-profile', action='store_true',
+                        help='let all clients share one settings folder, like concurrent invocations on one device')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    backend = StubBackend(args.backend_latency / 1000.0, args.slow_requests)
+    backend_thread = threading.Thread(target=backend.serve_forever)
+    backend_thread.daemon = True
+    backend_thread.start()
+    CMore.base_url = backend.url
+    CMore.playback_init_url = backend.url + '/init'
+
+    profile_root = tempfile.mkdtemp(prefix='cmore-loadtest-')
+    results = Results()
+    clients = []
+    for user_id in range(args.users):
+        if args.shared_profile:
+            settings_folder = profile_root
+        else:
+            settings_folder = os.path.join(profile_root, 'user{0}'.format(user_id))
+            os.makedirs(settings_folder)
+        clients.append(SimulatedClient(user_id, backend, settings_folder, args, results))
+
+    start_time = time.time()
+    try:
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+    finally:
+        duration = time.time() - start_time
+        backend.shutdown()
+        backend.server_close()
+        shutil.rmtree(profile_root, ignore_errors=True)
+
+    amplification = report(results, backend, duration)
+    if args.max_requests_per_action is not None:
+        exceeded = [x for x, y in amplification.items() if y > args.max_requests_per_action]
+        if exceeded:
+            print('request amplification limit exceeded by: {0}'.format(', '.join(sorted(exceeded))))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()